@@ -7,32 +7,217 @@ FTP server.
 """
 from __future__ import annotations
 
+import atexit
 import datetime
 import ftplib
-import json
+import functools
 import logging
 import os
+import queue
+import threading
+import time
 import typing
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+try:
+    # Faster json parsing if available
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 DEFAULT_PW = (
     ('Administrator', '1'),
     ('webguest', '1'),
 )
 DIRECTORY = 'pmps'
+# Bytes per transfer chunk, larger than ftplib's 8 KiB default
+BLOCKSIZE = 65536
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class _Session:
+    """
+    A logged-in FTP connection that we keep around between calls.
+
+    We track the login directory and the current working directory so that
+    a reused connection can be moved to whichever directory the next caller
+    asks for.
+    """
+    ftp_obj: ftplib.FTP
+    home: str
+    directory: typing.Optional[str] = None
+    last_used: float = field(default_factory=time.monotonic)
+    healthy: bool = True
+
+
+class FTPPool:
+    """
+    A bounded pool of logged-in FTP connections for each hostname.
+
+    Each hostname gets its own pool, so work on different PLCs can
+    proceed in parallel while never opening more than ``size`` sessions
+    to any one PLC. Connections that have sat idle for longer than
+    ``ttl`` seconds are closed and replaced on the next acquire.
+
+    Nothing closes idle connections on its own schedule. Long-running
+    callers should call ``close_idle`` periodically so that we don't keep
+    holding sessions on PLCs we're not using, and ``close_all`` when done.
+    ``close_all`` on the module's pool is registered to run at exit.
+
+    Parameters
+    ----------
+    size : int, optional
+        The maximum number of open connections per hostname.
+        Beckhoff PLCs only allow a few sessions, so keep this small.
+    ttl : float, optional
+        How long, in seconds, an idle connection may be reused.
+    timeout : float, optional
+        How long, in seconds, to wait for a free connection.
+    """
+    def __init__(self, size: int = 2, ttl: float = 60.0, timeout: float = 30.0):
+        self.size = size
+        self.ttl = ttl
+        self.timeout = timeout
+        self._pools: dict[str, queue.LifoQueue] = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, hostname: str) -> queue.LifoQueue:
+        """
+        Get the queue for one hostname, creating it on first use.
+
+        The queue starts full of None placeholders, each of which
+        represents the right to open one more connection.
+        """
+        with self._lock:
+            try:
+                return self._pools[hostname]
+            except KeyError:
+                pool = queue.LifoQueue(maxsize=self.size)
+                for _ in range(self.size):
+                    pool.put(None)
+                self._pools[hostname] = pool
+                return pool
+
+    def acquire(self, hostname: str) -> _Session:
+        """
+        Take a ready-to-use connection to hostname out of the pool.
+
+        This will reuse an idle connection if there is a healthy one,
+        open a new one if we're below the limit, or otherwise wait for
+        another caller to release one.
+        """
+        logger.debug('FTPPool.acquire(%s)', hostname)
+        pool = self._get_pool(hostname)
+        try:
+            session = pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'No free ftp connection to {hostname}')
+        try:
+            if session is not None:
+                if time.monotonic() - session.last_used > self.ttl:
+                    logger.debug('Idle connection to %s expired', hostname)
+                    _close(session.ftp_obj)
+                    session = None
+                elif not _is_alive(session.ftp_obj):
+                    logger.debug('Idle connection to %s is stale', hostname)
+                    _close(session.ftp_obj)
+                    session = None
+            if session is None:
+                session = _connect(hostname)
+        except BaseException:
+            # Give back our slot
+            pool.put(None)
+            raise
+        return session
+
+    def release(self, hostname: str, session: _Session, reuse: bool = True) -> None:
+        """
+        Return a connection to the pool after use.
+
+        If reuse is False, the connection is closed instead of being kept,
+        and a new one will be opened next time it is needed.
+        """
+        logger.debug('FTPPool.release(%s, reuse=%s)', hostname, reuse)
+        pool = self._get_pool(hostname)
+        if reuse:
+            session.last_used = time.monotonic()
+            pool.put(session)
+        else:
+            _close(session.ftp_obj)
+            pool.put(None)
+
+    def close_idle(self) -> None:
+        """
+        Close the idle connections that are older than the ttl.
+        """
+        self._close_idle(max_age=self.ttl)
+
+    def close_all(self) -> None:
+        """
+        Close every idle connection in every pool.
+
+        Connections that are in use are closed as usual when released.
+        """
+        self._close_idle(max_age=None)
+
+    def _close_idle(self, max_age: typing.Optional[float]) -> None:
+        """
+        Close idle connections older than max_age, or all of them if None.
+        """
+        with self._lock:
+            pools = list(self._pools.items())
+        now = time.monotonic()
+        for hostname, pool in pools:
+            items = []
+            while True:
+                try:
+                    items.append(pool.get_nowait())
+                except queue.Empty:
+                    break
+            keep = []
+            for session in items:
+                if session is None:
+                    continue
+                if max_age is None or now - session.last_used > max_age:
+                    logger.debug('Closing idle connection to %s', hostname)
+                    _close(session.ftp_obj)
+                else:
+                    keep.append(session)
+            # Free slots on the bottom, most recently used session on top
+            for _ in range(len(items) - len(keep)):
+                pool.put(None)
+            for session in reversed(keep):
+                pool.put(session)
+
+
+_FTP_POOL = FTPPool()
+atexit.register(_FTP_POOL.close_all)
+# Sessions currently checked out by ftp() in each thread, keyed by hostname
+_ACTIVE = threading.local()
+# Whether each hostname understands the MLSD command, once we know
+_MLSD_SUPPORTED: dict[str, bool] = {}
+
+
 @contextmanager
 def ftp(hostname: str, directory: typing.Optional[str] = None) -> ftplib.FTP:
     """
     Context manager that manages an FTP connection.
 
-    The connection will be opened and closed cleanly.
+    The connection is borrowed from a pool of logged-in connections for
+    this hostname and given back when the context exits. If a pooled
+    connection has gone stale, we quietly reconnect. If an unexpected error
+    occurs while the connection is in use, the connection is closed instead
+    of being returned to the pool.
     This will be used as a helper in other functions.
 
+    Nested calls for the same hostname in the same thread share the
+    outer call's connection. This lets a caller wrap several of the
+    helper functions in one ``with ftp(hostname):`` block so that they
+    all run over a single session.
+
     Parameters
     ----------
     hostname : str
@@ -49,33 +234,127 @@ def ftp(hostname: str, directory: typing.Optional[str] = None) -> ftplib.FTP:
     logger.debug('ftp(%s, %s)', hostname, directory)
     # Default directory
     directory = directory or DIRECTORY
-    # Create without connecting
-    ftp_obj = ftplib.FTP(hostname, timeout=2.0)
-    # Beckhoff docs recommend active mode
-    ftp_obj.set_pasv(False)
-    # Best-effort login using default passwords
-    rval = None
-    for user, pwd in DEFAULT_PW:
+    try:
+        active = _ACTIVE.sessions
+    except AttributeError:
+        active = _ACTIVE.sessions = {}
+    session = active.get(hostname)
+    if session is not None:
+        # Share the session from an outer ftp() call
+        outer_directory = session.directory
         try:
-            logger.debug('Try user=%s', user)
-            rval = ftp_obj.login(user=user, passwd=pwd)
+            _enter_directory(session, directory)
+            yield session.ftp_obj
         except ftplib.error_perm:
-            pass
-    # Fallback to anonymous login
-    # Try last, might have reduced perms
-    if rval is None:
-        logger.debug('Try anonymous login')
-        rval = ftp_obj.login()
-    if rval is None:
-        raise RuntimeError('Could not log into PLC using default passwords.')
-    # Create directory if it does not exist
-    if directory not in ftp_obj.nlst():
+            raise
+        except BaseException:
+            # Let the outer call know not to return this to the pool
+            session.healthy = False
+            raise
+        finally:
+            if session.healthy and outer_directory is not None:
+                _enter_directory(session, outer_directory)
+        return
+    session = _FTP_POOL.acquire(hostname)
+    active[hostname] = session
+    # We don't know what state the connection is in after most errors
+    reuse = False
+    try:
+        _enter_directory(session, directory)
+        # Should be ready to go
+        yield session.ftp_obj
+        reuse = True
+    except ftplib.error_perm:
+        # The server refused a command, but the connection is fine
+        reuse = True
+        raise
+    finally:
+        del active[hostname]
+        _FTP_POOL.release(hostname, session, reuse=reuse and session.healthy)
+
+
+def close_idle_connections() -> None:
+    """
+    Log out of pooled ftp connections that have been idle for a while.
+    """
+    _FTP_POOL.close_idle()
+
+
+def close_connections() -> None:
+    """
+    Log out of every pooled ftp connection that is not currently in use.
+    """
+    _FTP_POOL.close_all()
+
+
+def _connect(hostname: str) -> _Session:
+    """
+    Open a new FTP connection and log in.
+    """
+    logger.debug('_connect(%s)', hostname)
+    # Create without connecting
+    ftp_obj = ftplib.FTP(hostname, timeout=2.0)
+    try:
+        # Beckhoff docs recommend active mode
+        ftp_obj.set_pasv(False)
+        # Best-effort login using default passwords
+        rval = None
+        for user, pwd in DEFAULT_PW:
+            try:
+                logger.debug('Try user=%s', user)
+                rval = ftp_obj.login(user=user, passwd=pwd)
+            except ftplib.error_perm:
+                continue
+            # Stop at the first login that works
+            break
+        # Fallback to anonymous login
+        # Try last, might have reduced perms
+        if rval is None:
+            logger.debug('Try anonymous login')
+            rval = ftp_obj.login()
+        if rval is None:
+            raise RuntimeError('Could not log into PLC using default passwords.')
+        return _Session(ftp_obj=ftp_obj, home=ftp_obj.pwd())
+    except BaseException:
+        _close(ftp_obj)
+        raise
+
+
+def _is_alive(ftp_obj: ftplib.FTP) -> bool:
+    """
+    Check if a cached connection can still be used.
+    """
+    try:
+        ftp_obj.voidcmd('NOOP')
+    except (*ftplib.all_errors, EOFError):
+        return False
+    return True
+
+
+def _enter_directory(session: _Session, directory: str) -> None:
+    """
+    Move a connection into the requested directory, creating it if needed.
+    """
+    if session.directory == directory:
+        return
+    ftp_obj = session.ftp_obj
+    if session.directory is not None:
+        # Directories are relative to where we logged in
+        ftp_obj.cwd(session.home)
+        session.directory = None
+    # Put us into the proper directory, creating it if it does not exist
+    try:
+        ftp_obj.cwd(directory)
+    except ftplib.error_perm:
         ftp_obj.mkd(directory)
-    # Put us into the proper directory
-    ftp_obj.cwd(directory)
-    # Should be ready to go
-    yield ftp_obj
-    # Cleanup
+        ftp_obj.cwd(directory)
+    session.directory = directory
+
+
+def _close(ftp_obj: ftplib.FTP) -> None:
+    """
+    Close a connection, politely if possible.
+    """
     try:
         # Polite cleanup
         ftp_obj.quit()
@@ -138,23 +417,66 @@ class PLCFile:
             A single line of text output from the ftp LIST command.
         """
         logger.debug('PLCFile.from_list_line(%s)', line)
-        date, time, size, filename = line.split()
-        month, day, year = date.split('-')
-        hour, minute = time.split(':')
-        full_datetime = datetime.datetime(
-            year=int(year) + 2000,
-            month=int(month),
-            day=int(day),
-            hour=int(hour),
-            minute=int(minute),
-        )
+        filename, full_datetime, size = _parse_list_line(line)
         return cls(
             filename=filename,
             create_time=full_datetime,
-            size=int(size),
+            size=size,
+        )
+
+    @classmethod
+    def from_mlsd_entry(cls, name: str, facts: dict[str, str]) -> PLCFile:
+        """
+        Create a PLCFile from one entry yielded by ftplib.FTP.mlsd.
+
+        The ftp MLSD command gives us machine-readable facts about
+        each file. The modify fact is a UTC timestamp like
+        20221104215930, which we convert to local time to match the
+        times we get from the LIST command.
+
+        Parameters
+        ----------
+        name : str
+            The filename.
+        facts : dict of str
+            The facts about the file from the ftp MLSD command.
+        """
+        logger.debug('PLCFile.from_mlsd_entry(%s, %s)', name, facts)
+        # Drop fractional seconds, if present
+        modify = datetime.datetime.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')
+        full_datetime = (
+            modify.replace(tzinfo=datetime.timezone.utc)
+            .astimezone()
+            .replace(tzinfo=None)
+        )
+        return cls(
+            filename=name,
+            create_time=full_datetime,
+            size=int(facts['size']),
         )
 
 
+@functools.lru_cache(maxsize=1024)
+def _parse_list_line(line: str) -> tuple[str, datetime.datetime, int]:
+    """
+    Parse one line of ftp LIST output into filename, datetime, and size.
+
+    The same lines come back on every refresh until a file changes,
+    so we remember the results.
+    """
+    date, hour_minute, size, filename = line.split()
+    month, day, year = date.split('-')
+    hour, minute = hour_minute.split(':')
+    full_datetime = datetime.datetime(
+        year=int(year) + 2000,
+        month=int(month),
+        day=int(day),
+        hour=int(hour),
+        minute=int(minute),
+    )
+    return filename, full_datetime, int(size)
+
+
 def list_file_info(
     hostname: str,
     directory: typing.Optional[str] = None,
@@ -179,6 +501,32 @@ def list_file_info(
     logger.debug('list_file_info(%s, %s)', hostname, directory)
     lines = []
     with ftp(hostname=hostname, directory=directory) as ftp_obj:
+        if _MLSD_SUPPORTED.get(hostname, True):
+            try:
+                entries = list(ftp_obj.mlsd())
+            except ftplib.error_perm:
+                logger.debug('%s does not support MLSD, using LIST', hostname)
+                _MLSD_SUPPORTED[hostname] = False
+            else:
+                # Fact values are case-insensitive, and type is optional
+                files = [
+                    (name, facts) for name, facts in entries
+                    if facts.get('type', 'file').lower() == 'file'
+                ]
+                if all(
+                    'size' in facts and 'modify' in facts
+                    for _, facts in files
+                ):
+                    _MLSD_SUPPORTED[hostname] = True
+                    return [
+                        PLCFile.from_mlsd_entry(name, facts)
+                        for name, facts in files
+                    ]
+                logger.debug(
+                    '%s MLSD does not give size and modify, using LIST',
+                    hostname,
+                )
+                _MLSD_SUPPORTED[hostname] = False
         ftp_obj.retrlines('LIST', lines.append)
     return [PLCFile.from_list_line(line) for line in lines]
 
@@ -213,7 +561,7 @@ def upload_file(
         directory,
     )
     with ftp(hostname=hostname, directory=directory) as ftp_obj:
-        ftp_obj.storbinary(f'STOR {target_filename}', fd)
+        ftp_obj.storbinary(f'STOR {target_filename}', fd, blocksize=BLOCKSIZE)
 
 
 def upload_filename(
@@ -251,6 +599,45 @@ def upload_filename(
         )
 
 
+def download_file_bytes(
+    hostname: str,
+    filename: str,
+    directory: typing.Optional[str] = None,
+) -> bytearray:
+    """
+    Download the raw contents of a file from the PLC.
+
+    Parameters
+    ----------
+    hostname : str
+        The plc hostname to download from.
+    filename : str
+        The name of the file on the PLC.
+    directory : str, optional
+        The ftp subdirectory to read and write from
+        A default directory pmps is used if this argument is omitted.
+
+    Returns
+    -------
+    contents : bytearray
+        The bytes from the file.
+    """
+    logger.debug(
+        'download_file_bytes(%s, %s, %s)',
+        hostname,
+        filename,
+        directory,
+    )
+    contents = bytearray()
+    with ftp(hostname=hostname, directory=directory) as ftp_obj:
+        ftp_obj.retrbinary(
+            f'RETR {filename}',
+            contents.extend,
+            blocksize=BLOCKSIZE,
+        )
+    return contents
+
+
 def download_file_text(
     hostname: str,
     filename: str,
@@ -283,13 +670,11 @@ def download_file_text(
         filename,
         directory,
     )
-    byte_chunks = []
-    with ftp(hostname=hostname, directory=directory) as ftp_obj:
-        ftp_obj.retrbinary(f'RETR {filename}', byte_chunks.append)
-    contents = ''
-    for chunk in byte_chunks:
-        contents += chunk.decode('ascii')
-    return contents
+    return download_file_bytes(
+        hostname=hostname,
+        filename=filename,
+        directory=directory,
+    ).decode('ascii')
 
 
 def download_file_json_dict(
@@ -324,8 +709,9 @@ def download_file_json_dict(
         filename,
         directory,
     )
-    return json.loads(
-        download_file_text(
+    # json_loads accepts bytes directly, no need to decode first
+    return json_loads(
+        download_file_bytes(
             hostname=hostname,
             filename=filename,
             directory=directory,
@@ -350,8 +736,8 @@ def local_file_json_dict(filename: str) -> dict[str, dict[str, typing.Any]]:
         The dictionary data from the file stored on the local drive.
     """
     logger.debug('local_file_json_dict(%s)', filename)
-    with open(filename, 'r') as fd:
-        return json.load(fd)
+    with open(filename, 'rb') as fd:
+        return json_loads(fd.read())
 
 
 def compare_file(
@@ -363,6 +749,9 @@ def compare_file(
     """
     Compare a file saved locally to one on the PLC.
 
+    We check the PLC's file listing first, so a missing file or a file
+    of a different size is reported as different without downloading it.
+
     Parameters
     ----------
     hostname : str
@@ -388,10 +777,32 @@ def compare_file(
         plc_filename,
         directory,
     )
-    local_data = local_file_json_dict(filename=local_filename)
-    plc_data = download_file_json_dict(
-        hostname=hostname,
-        filename=plc_filename,
-        directory=directory,
-    )
-    return local_data == plc_data
+    plc_filename = plc_filename or os.path.basename(local_filename)
+    with open(local_filename, 'rb') as fd:
+        local_bytes = fd.read()
+    # Share one connection between the listing and the download
+    with ftp(hostname=hostname, directory=directory):
+        for plc_file in list_file_info(hostname=hostname, directory=directory):
+            if plc_file.filename == plc_filename:
+                break
+        else:
+            logger.debug('%s not found on %s', plc_filename, hostname)
+            return False
+        if plc_file.size != len(local_bytes):
+            logger.debug(
+                '%s is %d bytes on %s, expected %d',
+                plc_filename,
+                plc_file.size,
+                hostname,
+                len(local_bytes),
+            )
+            return False
+        plc_bytes = download_file_bytes(
+            hostname=hostname,
+            filename=plc_filename,
+            directory=directory,
+        )
+    if plc_bytes == local_bytes:
+        return True
+    # Same size but different bytes, the json data might still match
+    return json_loads(local_bytes) == json_loads(plc_bytes)
@@ -5,22 +5,26 @@ This is the locally run interface that allows us to communicate
 with both the database and the PLCs, showing useful diagnostic
 information and allowing file transfers.
 """
+import collections
+import contextlib
 import copy
 import datetime
 import enum
+import ftplib
 import logging
 import os
 import os.path
 import socket
-import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, ClassVar
+from typing import Any, Callable, ClassVar, Iterator, Optional
 
 import yaml
 from ophyd.utils.epics_pvs import AlarmSeverity
 from pcdscalc.pmps import get_bitmask_desc
 from pcdsutils.qt import DesignerDisplay
-from qtpy.QtCore import Qt
+from qtpy.QtCore import Qt, QTimer, Signal
 from qtpy.QtWidgets import (QAction, QDialog, QFileDialog, QInputDialog,
                             QLabel, QListWidget, QListWidgetItem, QMainWindow,
                             QMessageBox, QStatusBar, QTableWidget,
@@ -28,7 +32,8 @@ from qtpy.QtWidgets import (QAction, QDialog, QFileDialog, QInputDialog,
 
 from .beam_class import summarize_beam_class_bitmask
 from .export_data import ExportFile, get_export_dir, get_latest_exported_files
-from .ftp_data import (download_file_json_dict, download_file_text,
+from .ftp_data import (PLCFile, close_connections, close_idle_connections,
+                       download_file_json_dict, download_file_text, ftp,
                        list_file_info, upload_filename)
 from .ioc_data import AllStateBP, PLCDBControls
 
@@ -53,6 +58,10 @@ PARAMETER_HEADER_ORDER = [
     'notes',
     'special',
 ]
+# Number of downloaded PLC databases to keep around
+DB_CACHE_SIZE = 16
+# How often to log out of ftp sessions we haven't used lately, in ms
+FTP_REAP_INTERVAL_MS = 30_000
 
 
 class PMPSManagerGui(QMainWindow):
@@ -319,6 +328,11 @@ class PMPSManagerGui(QMainWindow):
         self.device_map.raise_()
         self.device_map.show()
 
+    def closeEvent(self, event) -> None:
+        """Stop any background work before the window goes away."""
+        self.tables.shutdown()
+        super().closeEvent(event)
+
 
 def select_default_config() -> list[str]:
     """
@@ -384,9 +398,8 @@ class DeviceMap(DesignerDisplay, QDialog):
                         data[device_name] = plc_name
 
         self.table.clearContents()
-        self.table.setRowCount(0)
+        self.table.setRowCount(len(data))
         for row_num, (device_name, plc_name) in enumerate(sorted(data.items())):
-            self.table.insertRow(row_num)
             self.table.setItem(
                 row_num,
                 0,
@@ -479,10 +492,36 @@ class SummaryTables(DesignerDisplay, QWidget):
     plc_row_map: dict[str, int]
     ok_rows: dict[int, bool]
     line: str
+    selected_hostname: Optional[str]
+    db_cache: collections.OrderedDict[
+        str, tuple[tuple[datetime.datetime, int], dict[str, dict[str, Any]]]
+    ]
+
+    # Emitted from worker threads, handled in the GUI thread
+    plc_probed = Signal(int, object)
+    plc_loaded = Signal(int, object)
 
     def __init__(self, plc_config: dict[str, str]):
         super().__init__()
         self.ok_rows = {}
+        self.db_cache = collections.OrderedDict()
+        # Rows that should refresh the export times when their probe lands
+        self._export_pending = set()
+        # Network checks are slow and wait-bound, run them in the background
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(32, max(1, len(plc_config))),
+        )
+        self._shutdown = False
+        # PLCs only allow a few ftp sessions, don't sit on idle ones
+        self._reap_timer = QTimer(self)
+        self._reap_timer.setInterval(FTP_REAP_INTERVAL_MS)
+        self._reap_timer.timeout.connect(
+            lambda: self._executor.submit(close_idle_connections)
+        )
+        self._reap_timer.start()
+        self.plc_probed.connect(self._apply_probe)
+        self.plc_loaded.connect(self._apply_load)
+        self.selected_hostname = None
         self.db_controls = {
             name: PLCDBControls(prefix=prefix + ':', name=name)
             for name, prefix in plc_config.items()
@@ -491,12 +530,13 @@ class SummaryTables(DesignerDisplay, QWidget):
         self.plc_row_map = {}
         self.line = 'l'
         self._test_mode = False
-        for hostname in plc_config:
-            if '-tst-' in hostname:
-                self._test_mode = True
-            self.add_plc(hostname)
-        self.update_export_times()
-        self.plc_table.resizeColumnsToContents()
+        with updates_paused(self.plc_table):
+            for hostname in plc_config:
+                if '-tst-' in hostname:
+                    self._test_mode = True
+                self.add_plc(hostname)
+            self.update_export_times()
+            self.plc_table.resizeColumnsToContents()
         self.plc_table.cellActivated.connect(self.plc_selected)
         self.device_list.itemActivated.connect(self.device_selected)
 
@@ -531,8 +571,9 @@ class SummaryTables(DesignerDisplay, QWidget):
         self.plc_table.setItem(row, PLCTableColumns.EXPORT, export_time_item)
         self.plc_table.setItem(row, PLCTableColumns.UPLOAD, upload_time_item)
         self.plc_table.setItem(row, PLCTableColumns.RELOAD, param_load_time)
-        self.update_plc_row(row, update_export=False)
+        status_item.setText('checking')
         self.plc_row_map[hostname] = row
+        self.start_probe(row, hostname)
 
         def on_refresh(value, **kwargs):
             param_load_time.setText(
@@ -545,44 +586,102 @@ class SummaryTables(DesignerDisplay, QWidget):
 
     def update_plc_row(self, row: int, update_export: bool = True) -> None:
         """
-        Update the status information in the PLC table for one row.
+        Refresh the status information in the PLC table for one row.
 
-        This is limited to the file read actions. We'll do this once on
-        startup and again when the row is selected.
+        This is limited to the file read actions, which run in the
+        background via start_probe. The row is updated when they finish.
         Data source from PVs will be updated on monitor outside the scope
         of this method.
         """
         logger.debug('update_plc_row(%d)', row)
         hostname = self.plc_table.item(row, PLCTableColumns.NAME).text()
         logger.debug('row %d is %s', row, hostname)
-        if check_server_online(hostname):
+        if update_export:
+            self._export_pending.add(row)
+        self.start_probe(row, hostname)
+
+    def start_probe(self, row: int, hostname: str) -> None:
+        """
+        Check on a PLC in a background thread and update its row when done.
+        """
+        logger.debug('start_probe(%d, %s)', row, hostname)
+        self._run_in_background(
+            self.plc_probed,
+            row,
+            lambda exc: PLCProbe(hostname=hostname, online=False, error=exc),
+            probe_plc,
+            hostname,
+        )
+
+    def _run_in_background(
+        self,
+        signal: Signal,
+        row: int,
+        on_error: Callable[[Exception], Any],
+        func: Callable[..., Any],
+        *args: Any,
+    ) -> None:
+        """
+        Run func(*args) in the thread pool, then emit signal(row, result).
+
+        Emitting the signal from the worker thread is how the result gets
+        to the GUI thread. If func raises, the result is on_error(exc)
+        instead, so that the row never gets stuck waiting.
+        """
+        def on_done(future: Future) -> None:
+            if self._shutdown or future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as exc:
+                logger.debug('%s%s failed', func.__name__, args, exc_info=True)
+                result = on_error(exc)
+            signal.emit(row, result)
+
+        self._executor.submit(func, *args).add_done_callback(on_done)
+
+    def _apply_probe(self, row: int, probe: 'PLCProbe') -> None:
+        """
+        Show the results from probe_plc in the PLC table.
+        """
+        if probe.online:
             text = 'online'
         else:
             text = 'offline'
         self.plc_table.item(row, PLCTableColumns.STATUS).setText(text)
-        info = []
-        try:
-            info = list_file_info(hostname)
-        except Exception as exc:
-            logger.error('Error reading file list from %s: %s', hostname, exc)
-            logger.debug('list_file_info(%s) failed', hostname, exc_info=True)
+        if probe.error is not None:
+            exc = probe.error
+            logger.error('Error reading file list from %s: %s', probe.hostname, exc)
             text = str(exc)
             if '] ' in text and text.startswith('[Errno'):
                 text = text.split('] ')[1]
             text = text.capitalize()
             self.ok_rows[row] = False
         else:
-            logger.debug('%s found file info %s', hostname, info)
+            logger.debug('%s found file info %s', probe.hostname, probe.info)
             text = 'No upload found'
             self.ok_rows[row] = True
-        filename = hostname_to_filename(hostname)
-        for file_info in info:
+        filename = hostname_to_filename(probe.hostname)
+        for file_info in probe.info:
             if file_info.filename == filename:
                 text = file_info.create_time.ctime()
                 break
         self.plc_table.item(row, PLCTableColumns.UPLOAD).setText(text)
-        if update_export:
+        if row in self._export_pending:
+            self._export_pending.discard(row)
             self.update_export_times()
+        self.plc_table.resizeColumnsToContents()
+
+    def shutdown(self) -> None:
+        """
+        Stop background work and log out of idle ftp sessions.
+
+        Probes that have not started yet are dropped.
+        """
+        self._shutdown = True
+        self._reap_timer.stop()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        close_connections()
 
     def update_plc_row_by_hostname(self, hostname: str) -> None:
         """
@@ -605,33 +704,27 @@ class SummaryTables(DesignerDisplay, QWidget):
             else:
                 export_item.setText(plc_export.export_time.ctime())
 
-    def get_cached_db(self, hostname: str) -> bool:
+    def set_cached_db(self, hostname: str, load: 'PLCLoad') -> bool:
         """
-        Download and cache the full contents of the database file.
+        Cache the full contents of the database file from load_plc.
 
         Returns True if successful and False otherwise.
         """
-        self.cached_db = None
-        filename = hostname_to_filename(hostname)
-        try:
-            self.cached_db = download_file_json_dict(
-                hostname=hostname,
-                filename=filename,
-            )
-            logger.debug('%s found db info %s', hostname, self.cached_db)
-        except Exception:
+        self.cached_db = load.db
+        if load.error is not None:
+            filename = hostname_to_filename(hostname)
             logger.error(
                 'Could not download %s from %s',
                 filename,
                 hostname,
             )
-            logger.debug(
-                'download_file_json_dict(%s, %s) failed',
-                hostname,
-                filename,
-                exc_info=True,
-            )
             return False
+        logger.debug('%s found db info %s', hostname, self.cached_db)
+        if load.version is not None:
+            self.db_cache[hostname] = (load.version, self.cached_db)
+            self.db_cache.move_to_end(hostname)
+            while len(self.db_cache) > DB_CACHE_SIZE:
+                self.db_cache.popitem(last=False)
         return True
 
     def clear_loaded_table(self) -> None:
@@ -655,7 +748,7 @@ class SummaryTables(DesignerDisplay, QWidget):
         """
         Assemble information for the "loaded" table.
 
-        Requires a valid cached database from get_cached_db
+        Requires a valid cached database from set_cached_db
         """
         self.clear_loaded_table()
         self.loaded_table.setCellWidget(
@@ -735,7 +828,7 @@ class SummaryTables(DesignerDisplay, QWidget):
         """
         Populate the device list.
 
-        Requires a valid cached database from get_cached_db
+        Requires a valid cached database from set_cached_db
         """
         self.device_list.clear()
         self.param_table.clear()
@@ -745,8 +838,8 @@ class SummaryTables(DesignerDisplay, QWidget):
         except KeyError:
             logger.error('Did not find required entry %s', key)
             return
-        for device_name in self.param_dict:
-            self.device_list.addItem(device_name)
+        with updates_paused(self.device_list):
+            self.device_list.addItems(list(self.param_dict))
         logger.info(
             'Found %d devices in %s local database',
             len(self.param_dict),
@@ -832,16 +925,18 @@ class SummaryTables(DesignerDisplay, QWidget):
         )
 
     def _fill_params(self, table, header, params) -> None:
-        for state_info in params.values():
-            row = table.rowCount()
-            table.insertRow(row)
-            for key, value in state_info.items():
-                col = header.index(key)
-                value = str(value)
-                item = QTableWidgetItem(value)
-                self.set_param_cell_tooltip(item, key, value)
-                table.setItem(row, col, item)
-        table.resizeColumnsToContents()
+        with updates_paused(table):
+            # Allocate all the rows at once rather than one insertRow per state
+            first_row = table.rowCount()
+            table.setRowCount(first_row + len(params))
+            for row, state_info in enumerate(params.values(), start=first_row):
+                for key, value in state_info.items():
+                    col = header.index(key)
+                    value = str(value)
+                    item = QTableWidgetItem(value)
+                    self.set_param_cell_tooltip(item, key, value)
+                    table.setItem(row, col, item)
+            table.resizeColumnsToContents()
 
     def get_states_prefixes(self, device_name: str) -> list[str]:
         """
@@ -898,9 +993,41 @@ class SummaryTables(DesignerDisplay, QWidget):
         self.ioc_table.setColumnCount(0)
         self.clear_loaded_table()
         self.device_list.clear()
-        self.update_plc_row(row)
+        self.selected_hostname = hostname
+        self.start_load(row)
+
+    def start_load(self, row: int) -> None:
+        """
+        Update one PLC row and load its database in a background thread.
+
+        The tables are filled in when the results arrive, as long as
+        this PLC is still the selected one.
+        """
+        hostname = self.plc_table.item(row, PLCTableColumns.NAME).text()
+        logger.debug('start_load(%d, %s)', row, hostname)
+        self._run_in_background(
+            self.plc_loaded,
+            row,
+            lambda exc: PLCLoad(
+                probe=PLCProbe(hostname=hostname, online=False, error=exc),
+            ),
+            load_plc,
+            hostname,
+            self.db_cache.get(hostname),
+        )
+
+    def _apply_load(self, row: int, load: 'PLCLoad') -> None:
+        """
+        Show the results from load_plc in the PLC row and the other tables.
+        """
+        hostname = load.probe.hostname
+        self._apply_probe(row, load.probe)
+        self.update_export_times()
+        if hostname != self.selected_hostname:
+            logger.debug('%s is no longer selected', hostname)
+            return
         if self.ok_rows.get(row, False):
-            if self.get_cached_db(hostname):
+            if self.set_cached_db(hostname, load):
                 self.fill_loaded_table(hostname)
                 self.fill_device_list(hostname)
 
@@ -918,6 +1045,8 @@ class SummaryTables(DesignerDisplay, QWidget):
         This will select the corresponding PLC in the GUI in order to reload and
         show the pertinent information for that PLC.
         """
+        # We know the file changed, even if the listing can't show it yet
+        self.db_cache.pop(hostname, None)
         for plc_row in range(self.plc_table.rowCount()):
             if self.plc_table.item(plc_row, PLCTableColumns.NAME).text() == hostname:
                 # Visual selection, doesn't "activate" (double-click) the cell
@@ -955,18 +1084,139 @@ class StatusBarHandler(logging.Handler):
         self.status_bar.addWidget(self.label)
 
 
-def check_server_online(hostname: str) -> bool:
+@dataclass
+class PLCProbe:
     """
-    Ping a hostname to determine if it is network accessible or not.
+    The results of checking on one PLC over the network.
+    """
+    hostname: str
+    online: bool
+    info: list[PLCFile] = field(default_factory=list)
+    error: Optional[Exception] = None
+
+
+def probe_plc(hostname: str) -> PLCProbe:
+    """
+    Check if a PLC is online and which files it has.
+
+    Like load_plc, this is blocking and meant for a worker thread.
     """
     try:
-        subprocess.run(
-            ['ping', '-c', '1', hostname],
-            capture_output=True,
+        info = list_file_info(hostname)
+    except Exception as exc:
+        logger.debug('list_file_info(%s) failed', hostname, exc_info=True)
+        # Only spend another connection finding out why it failed
+        return PLCProbe(
+            hostname=hostname,
+            online=check_server_online(hostname),
+            error=exc,
         )
-        return True
-    except Exception:
-        logger.debug('%s ping failed', hostname, exc_info=True)
+    return PLCProbe(hostname=hostname, online=True, info=info)
+
+
+@dataclass
+class PLCLoad:
+    """
+    The results of checking on one PLC and reading its database file.
+    """
+    probe: PLCProbe
+    db: Optional[dict[str, dict[str, Any]]] = None
+    version: Optional[tuple[datetime.datetime, int]] = None
+    error: Optional[Exception] = None
+
+
+def load_plc(
+    hostname: str,
+    cached: Optional[tuple[tuple[datetime.datetime, int], dict[str, Any]]] = None,
+) -> PLCLoad:
+    """
+    Check on a PLC and get its database file, all over one ftp session.
+
+    The download is skipped if the file on the PLC has the same
+    modification time and size as the cached version, if provided.
+    File listings may only have minute resolution, so a file modified
+    during the current minute is always downloaded and never given a
+    version to cache: it could still change without the listing showing it.
+    This does blocking network calls and is safe to run in a worker thread:
+    errors are stored on the result rather than raised.
+    """
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(ftp(hostname))
+        except Exception as exc:
+            # Same result as failing the file listing, without trying again
+            logger.debug('ftp(%s) failed', hostname, exc_info=True)
+            probe = PLCProbe(
+                hostname=hostname,
+                online=check_server_online(hostname),
+                error=exc,
+            )
+            return PLCLoad(probe=probe)
+        # We're logged in, no need to spend another connection checking
+        try:
+            info = list_file_info(hostname)
+        except Exception as exc:
+            logger.debug('list_file_info(%s) failed', hostname, exc_info=True)
+            probe = PLCProbe(hostname=hostname, online=True, error=exc)
+            return PLCLoad(probe=probe)
+        load = PLCLoad(probe=PLCProbe(hostname=hostname, online=True, info=info))
+        filename = hostname_to_filename(hostname)
+        for file_info in load.probe.info:
+            if file_info.filename == filename:
+                if is_settled(file_info.create_time):
+                    load.version = (file_info.create_time, file_info.size)
+                break
+        if cached is not None and load.version is not None:
+            cached_version, cached_db = cached
+            if load.version == cached_version:
+                logger.debug('Using cached db info for %s', hostname)
+                load.db = cached_db
+                return load
+        try:
+            load.db = download_file_json_dict(
+                hostname=hostname,
+                filename=filename,
+            )
+        except Exception as exc:
+            logger.debug(
+                'download_file_json_dict(%s, %s) failed',
+                hostname,
+                filename,
+                exc_info=True,
+            )
+            load.error = exc
+        return load
+
+
+def is_settled(
+    create_time: datetime.datetime,
+    now: Optional[datetime.datetime] = None,
+) -> bool:
+    """
+    Check if a minute-resolution timestamp is entirely in the past.
+
+    Until then, the file could be rewritten without its listed
+    modification time changing. now defaults to the current local time.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    minute = create_time.replace(second=0, microsecond=0)
+    return minute + datetime.timedelta(minutes=1) <= now
+
+
+def check_server_online(hostname: str, timeout: float = 0.5) -> bool:
+    """
+    Open a TCP connection to a hostname's FTP port to see if it is accessible.
+
+    This checks the service we actually need rather than relying on ping,
+    which PLC firewalls may drop.
+    """
+    try:
+        with socket.create_connection((hostname, ftplib.FTP_PORT), timeout=timeout):
+            return True
+    except (OSError, UnicodeError):
+        # UnicodeError is from hostnames that can't be encoded for lookup
+        logger.debug('%s connect failed', hostname, exc_info=True)
         return False
 
 
@@ -984,6 +1234,21 @@ def hostname_to_filename(hostname: str) -> str:
     return hostname_to_key(hostname) + '.json'
 
 
+@contextlib.contextmanager
+def updates_paused(widget: QWidget) -> Iterator[None]:
+    """
+    Hold off on repainting a widget until the end of the block.
+
+    Use this around loops that change many cells so that Qt only
+    repaints once.
+    """
+    widget.setUpdatesEnabled(False)
+    try:
+        yield
+    finally:
+        widget.setUpdatesEnabled(True)
+
+
 def rich_color(text: str, color: str) -> str:
     """
     Adds html color tags to input text.
@@ -0,0 +1,459 @@
+import contextlib
+import datetime
+import ftplib
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from pmpsdb_client import ftp_data
+from pmpsdb_client.ftp_data import (FTPPool, PLCFile, _parse_list_line, _Session,
+                                    compare_file, download_file_json_dict,
+                                    download_file_text, ftp, list_file_info,
+                                    local_file_json_dict)
+
+
+class FakeFTP:
+    """
+    Stand-in for ftplib.FTP that records the commands we care about.
+    """
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.cwd_calls = []
+
+    def voidcmd(self, cmd):
+        if not self.alive:
+            raise EOFError
+        return '200 OK'
+
+    def cwd(self, directory):
+        self.cwd_calls.append(directory)
+
+    def mkd(self, directory):
+        pass
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """
+    Replace _connect and the module pool, returning the sessions created.
+    """
+    created = []
+
+    def fake_connect(hostname):
+        session = _Session(ftp_obj=FakeFTP(), home='/')
+        created.append(session)
+        return session
+
+    monkeypatch.setattr(ftp_data, '_connect', fake_connect)
+    monkeypatch.setattr(ftp_data, '_FTP_POOL', FTPPool(size=2, timeout=0.1))
+    monkeypatch.setattr(ftp_data, '_ACTIVE', threading.local())
+    return created
+
+
+def test_pool_slot_limit(connections):
+    pool = FTPPool(size=2, timeout=0.1)
+    first = pool.acquire('plc')
+    second = pool.acquire('plc')
+    assert first is not second
+    with pytest.raises(TimeoutError):
+        pool.acquire('plc')
+    pool.release('plc', first)
+    assert pool.acquire('plc') is first
+    assert len(connections) == 2
+
+
+def test_pool_acquire_timeout(connections):
+    pool = FTPPool(size=1, timeout=0.1)
+    pool.acquire('plc')
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pool.acquire('plc')
+    assert time.monotonic() - start >= 0.1
+    # Other hosts have their own slots
+    pool.acquire('other_plc')
+
+
+def test_pool_connect_failure_returns_slot(connections, monkeypatch):
+    pool = FTPPool(size=1, timeout=0.1)
+    fake_connect = ftp_data._connect
+
+    def broken_connect(hostname):
+        raise ConnectionRefusedError
+
+    monkeypatch.setattr(ftp_data, '_connect', broken_connect)
+    with pytest.raises(ConnectionRefusedError):
+        pool.acquire('plc')
+    monkeypatch.setattr(ftp_data, '_connect', fake_connect)
+    assert pool.acquire('plc') is connections[0]
+
+
+def test_pool_replaces_stale_session(connections):
+    pool = FTPPool(size=1, timeout=0.1)
+    session = pool.acquire('plc')
+    pool.release('plc', session)
+    session.ftp_obj.alive = False
+    new_session = pool.acquire('plc')
+    assert new_session is not session
+    assert session.ftp_obj.closed
+
+
+def test_pool_replaces_expired_session(connections):
+    pool = FTPPool(size=1, ttl=60, timeout=0.1)
+    session = pool.acquire('plc')
+    pool.release('plc', session)
+    session.last_used -= 120
+    new_session = pool.acquire('plc')
+    assert new_session is not session
+    assert session.ftp_obj.closed
+
+
+def test_pool_release_without_reuse(connections):
+    pool = FTPPool(size=1, timeout=0.1)
+    session = pool.acquire('plc')
+    pool.release('plc', session, reuse=False)
+    assert session.ftp_obj.closed
+    assert pool.acquire('plc') is not session
+
+
+def test_pool_close_idle(connections):
+    pool = FTPPool(size=2, ttl=60, timeout=0.1)
+    old = pool.acquire('plc')
+    new = pool.acquire('plc')
+    pool.release('plc', old)
+    pool.release('plc', new)
+    old.last_used -= 120
+    pool.close_idle()
+    assert old.ftp_obj.closed
+    assert not new.ftp_obj.closed
+    assert pool.acquire('plc') is new
+    pool.close_all()
+    assert not new.ftp_obj.closed
+    pool.release('plc', new)
+    pool.close_all()
+    assert new.ftp_obj.closed
+
+
+class FakeLoginFTP:
+    """
+    Stand-in for ftplib.FTP that only accepts some logins.
+    """
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.logins = []
+
+    def set_pasv(self, val):
+        pass
+
+    def login(self, user='anonymous', passwd=''):
+        self.logins.append(user)
+        if user not in self.accepted:
+            raise ftplib.error_perm('530 Login incorrect')
+        return '230 Logged in'
+
+    def pwd(self):
+        return '/'
+
+
+@pytest.mark.parametrize(
+    'accepted, logins',
+    [
+        (['Administrator', 'webguest'], ['Administrator']),
+        (['webguest'], ['Administrator', 'webguest']),
+        (['anonymous'], ['Administrator', 'webguest', 'anonymous']),
+    ],
+    ids=['Administrator', 'webguest', 'anonymous'],
+)
+def test_connect_stops_at_first_login(monkeypatch, accepted, logins):
+    fake = FakeLoginFTP(accepted)
+    monkeypatch.setattr(ftplib, 'FTP', lambda hostname, timeout: fake)
+    session = ftp_data._connect('plc')
+    assert session.ftp_obj is fake
+    assert fake.logins == logins
+
+
+def test_ftp_nested_shares_session(connections):
+    with ftp('plc') as outer:
+        assert outer.cwd_calls == ['pmps']
+        with ftp('plc', directory='other') as inner:
+            assert inner is outer
+            assert outer.cwd_calls == ['pmps', '/', 'other']
+        # Back where the outer call expects to be
+        assert outer.cwd_calls == ['pmps', '/', 'other', '/', 'pmps']
+        assert connections[0].directory == 'pmps'
+    assert len(connections) == 1
+    assert not outer.closed
+
+
+def test_ftp_error_perm_keeps_connection(connections):
+    with pytest.raises(ftplib.error_perm):
+        with ftp('plc') as ftp_obj:
+            raise ftplib.error_perm('550 No such file')
+    assert not ftp_obj.closed
+    with ftp('plc') as next_ftp_obj:
+        assert next_ftp_obj is ftp_obj
+
+
+def test_ftp_other_error_drops_connection(connections):
+    with pytest.raises(RuntimeError):
+        with ftp('plc') as ftp_obj:
+            raise RuntimeError
+    assert ftp_obj.closed
+    with ftp('plc') as next_ftp_obj:
+        assert next_ftp_obj is not ftp_obj
+
+
+def test_ftp_nested_error_drops_connection(connections):
+    with ftp('plc') as outer:
+        with pytest.raises(RuntimeError):
+            with ftp('plc'):
+                raise RuntimeError
+        assert not connections[0].healthy
+    assert outer.closed
+    with ftp('plc') as next_ftp_obj:
+        assert next_ftp_obj is not outer
+
+
+class FakeRetrFTP:
+    """
+    Stand-in for ftplib.FTP that sends a file back in small chunks.
+    """
+    def __init__(self, contents, chunk_size=3):
+        self.contents = contents
+        self.chunk_size = chunk_size
+        self.chunks_sent = 0
+
+    def retrbinary(self, cmd, callback, blocksize=8192):
+        for start in range(0, len(self.contents), self.chunk_size):
+            callback(self.contents[start:start + self.chunk_size])
+            self.chunks_sent += 1
+
+
+@pytest.fixture
+def retr_ftp(monkeypatch):
+    """
+    Make ftp() yield a FakeRetrFTP holding a small json file.
+    """
+    fake = FakeRetrFTP(b'{"plc": {"a": 1, "b": [1, 2]}}')
+    monkeypatch.setattr(
+        ftp_data,
+        'ftp',
+        lambda hostname, directory=None: contextlib.nullcontext(fake),
+    )
+    return fake
+
+
+def test_download_file_chunks(retr_ftp):
+    assert download_file_text('plc', 'plc.json') == retr_ftp.contents.decode('ascii')
+    assert retr_ftp.chunks_sent > 1
+    assert download_file_json_dict('plc', 'plc.json') == {
+        'plc': {'a': 1, 'b': [1, 2]},
+    }
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def json_loads(request, monkeypatch):
+    """
+    Run the test with each json parser that ftp_data might pick.
+    """
+    if request.param == 'orjson':
+        loads = pytest.importorskip('orjson').loads
+    else:
+        loads = json.loads
+    monkeypatch.setattr(ftp_data, 'json_loads', loads)
+    return loads
+
+
+def test_download_file_json_dict_parsers(retr_ftp, json_loads):
+    assert download_file_json_dict('plc', 'plc.json') == {
+        'plc': {'a': 1, 'b': [1, 2]},
+    }
+
+
+def test_local_file_json_dict_parsers(tmp_path, json_loads):
+    path = tmp_path / 'local.json'
+    path.write_bytes(b'{"plc": {"a": 1, "b": [1, 2]}}')
+    assert local_file_json_dict(str(path)) == {'plc': {'a': 1, 'b': [1, 2]}}
+
+
+@pytest.fixture
+def plc_file(monkeypatch):
+    """
+    Stub out the network calls compare_file makes.
+
+    Returns a dict: set 'contents' to put a file on the fake PLC, and
+    'downloads' counts how many times we fetched it.
+    """
+    plc = {'contents': None, 'downloads': 0}
+
+    def fake_list_file_info(hostname, directory=None):
+        if plc['contents'] is None:
+            return []
+        return [
+            PLCFile('plc.json', datetime.datetime(2023, 1, 1), len(plc['contents']))
+        ]
+
+    def fake_download_file_bytes(hostname, filename, directory=None):
+        plc['downloads'] += 1
+        return bytearray(plc['contents'])
+
+    monkeypatch.setattr(
+        ftp_data,
+        'ftp',
+        lambda hostname, directory=None: contextlib.nullcontext(),
+    )
+    monkeypatch.setattr(ftp_data, 'list_file_info', fake_list_file_info)
+    monkeypatch.setattr(ftp_data, 'download_file_bytes', fake_download_file_bytes)
+    return plc
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    path = tmp_path / 'local.json'
+    path.write_bytes(b'{"a": 1}')
+    return str(path)
+
+
+def test_compare_file_missing(plc_file, local_file):
+    assert not compare_file('plc', local_file, 'plc.json')
+    assert plc_file['downloads'] == 0
+
+
+def test_compare_file_size_mismatch(plc_file, local_file):
+    plc_file['contents'] = b'{"a": 10}'
+    assert not compare_file('plc', local_file, 'plc.json')
+    assert plc_file['downloads'] == 0
+
+
+def test_compare_file_identical(plc_file, local_file):
+    plc_file['contents'] = b'{"a": 1}'
+    assert compare_file('plc', local_file, 'plc.json')
+    assert plc_file['downloads'] == 1
+
+
+def test_compare_file_same_size_different_data(plc_file, local_file):
+    plc_file['contents'] = b'{"a": 2}'
+    assert not compare_file('plc', local_file, 'plc.json')
+    assert plc_file['downloads'] == 1
+
+
+def test_compare_file_same_size_same_data(plc_file, local_file):
+    plc_file['contents'] = b'{ "a":1}'
+    assert compare_file('plc', local_file, 'plc.json')
+
+
+@pytest.fixture
+def eastern_standard_time():
+    """
+    Run the test with the local timezone fixed at UTC-5.
+    """
+    if not hasattr(time, 'tzset'):
+        pytest.skip('Cannot change timezone on this platform')
+    old_tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'EST5'
+    time.tzset()
+    yield
+    if old_tz is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = old_tz
+    time.tzset()
+
+
+def test_parse_list_line():
+    line = '11-04-22  13:59                16439 kfe-motion.json'
+    assert _parse_list_line(line) == (
+        'kfe-motion.json',
+        datetime.datetime(2022, 11, 4, 13, 59),
+        16439,
+    )
+    assert PLCFile.from_list_line(line) == PLCFile(
+        'kfe-motion.json',
+        datetime.datetime(2022, 11, 4, 13, 59),
+        16439,
+    )
+
+
+def test_from_mlsd_entry(eastern_standard_time):
+    facts = {'type': 'file', 'size': '16439', 'modify': '20221104215930.123'}
+    assert PLCFile.from_mlsd_entry('kfe-motion.json', facts) == PLCFile(
+        'kfe-motion.json',
+        datetime.datetime(2022, 11, 4, 16, 59, 30),
+        16439,
+    )
+
+
+class FakeListFTP:
+    """
+    Stand-in for ftplib.FTP that answers directory listings.
+    """
+    def __init__(self, mlsd_entries):
+        self.mlsd_entries = mlsd_entries
+
+    def mlsd(self):
+        if self.mlsd_entries is None:
+            raise ftplib.error_perm('500 Unknown command')
+        return iter(self.mlsd_entries)
+
+    def retrlines(self, cmd, callback):
+        callback('11-04-22  13:59                16439 kfe-motion.json')
+
+
+@pytest.fixture
+def list_ftp(monkeypatch):
+    """
+    Make ftp() yield a FakeListFTP, returning a function to set its entries.
+    """
+    monkeypatch.setattr(ftp_data, '_MLSD_SUPPORTED', {})
+
+    def set_entries(mlsd_entries):
+        fake = FakeListFTP(mlsd_entries)
+        monkeypatch.setattr(
+            ftp_data,
+            'ftp',
+            lambda hostname, directory=None: contextlib.nullcontext(fake),
+        )
+
+    return set_entries
+
+
+def test_list_file_info_mlsd(list_ftp):
+    list_ftp([
+        ('.', {'type': 'cdir'}),
+        ('sub', {'type': 'dir', 'modify': '20221104215930'}),
+        ('a.json', {'type': 'File', 'size': '10', 'modify': '20221104215930'}),
+        ('b.json', {'size': '20', 'modify': '20221104215930'}),
+    ])
+    info = list_file_info('plc')
+    assert [(data.filename, data.size) for data in info] == [
+        ('a.json', 10),
+        ('b.json', 20),
+    ]
+    assert ftp_data._MLSD_SUPPORTED['plc']
+
+
+@pytest.mark.parametrize(
+    'mlsd_entries',
+    [
+        None,
+        [('a.json', {'type': 'file', 'modify': '20221104215930'})],
+        [('a.json', {'type': 'file', 'size': '10'})],
+    ],
+    ids=['unsupported', 'no size', 'no modify'],
+)
+def test_list_file_info_list_fallback(list_ftp, mlsd_entries):
+    list_ftp(mlsd_entries)
+    info = list_file_info('plc')
+    assert [(data.filename, data.size) for data in info] == [
+        ('kfe-motion.json', 16439),
+    ]
+    assert not ftp_data._MLSD_SUPPORTED['plc']
@@ -1,5 +1,162 @@
+import contextlib
+import datetime
+import functools
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
 def test_gui_imports():
     """
     Minimal test that we can import the items needed to run the gui
     """
     import pmpsdb_client.cli.run_gui  # noqa: F401
+
+
+@pytest.fixture
+def fake_plc(monkeypatch):
+    """
+    Stub out the network calls load_plc makes, returning the download log.
+    """
+    from pmpsdb_client import gui
+
+    downloads = []
+    files = []
+
+    def fake_download(hostname, filename):
+        downloads.append(filename)
+        return {hostname: {}}
+
+    monkeypatch.setattr(gui, 'ftp', lambda hostname: contextlib.nullcontext())
+    monkeypatch.setattr(gui, 'check_server_online', lambda hostname: True)
+    monkeypatch.setattr(gui, 'list_file_info', lambda hostname: files)
+    monkeypatch.setattr(gui, 'download_file_json_dict', fake_download)
+    return files, downloads
+
+
+def test_load_plc_uses_cache_for_settled_file(fake_plc):
+    from pmpsdb_client.ftp_data import PLCFile
+    from pmpsdb_client.gui import load_plc
+
+    files, downloads = fake_plc
+    create_time = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    files.append(PLCFile('plc.json', create_time, 100))
+    load = load_plc('plc')
+    assert downloads == ['plc.json']
+    assert load.version == (create_time, 100)
+    cached_load = load_plc('plc', cached=(load.version, load.db))
+    assert downloads == ['plc.json']
+    assert cached_load.db is load.db
+
+
+def test_load_plc_ignores_cache_for_current_minute(fake_plc, monkeypatch):
+    from pmpsdb_client import gui
+    from pmpsdb_client.ftp_data import PLCFile
+
+    files, downloads = fake_plc
+    create_time = datetime.datetime(2023, 1, 1, 12, 30)
+    now = create_time + datetime.timedelta(seconds=59)
+    monkeypatch.setattr(
+        gui,
+        'is_settled',
+        functools.partial(gui.is_settled, now=now),
+    )
+    files.append(PLCFile('plc.json', create_time, 100))
+    load = gui.load_plc('plc', cached=((create_time, 100), {}))
+    assert downloads == ['plc.json']
+    assert load.version is None
+
+
+def test_is_settled():
+    from pmpsdb_client.gui import is_settled
+
+    create_time = datetime.datetime(2023, 1, 1, 12, 30, 15)
+    assert not is_settled(create_time, now=datetime.datetime(2023, 1, 1, 12, 30, 59))
+    assert is_settled(create_time, now=datetime.datetime(2023, 1, 1, 12, 31))
+
+
+def test_load_plc_skips_online_check(fake_plc, monkeypatch):
+    from pmpsdb_client import gui
+
+    def fail_check(hostname):
+        raise AssertionError('Should not open another connection')
+
+    monkeypatch.setattr(gui, 'check_server_online', fail_check)
+    load = gui.load_plc('plc')
+    assert load.probe.online
+    assert load.probe.error is None
+
+
+def test_probe_plc_skips_online_check(fake_plc, monkeypatch):
+    from pmpsdb_client import gui
+
+    def fail_check(hostname):
+        raise AssertionError('Should not open another connection')
+
+    monkeypatch.setattr(gui, 'check_server_online', fail_check)
+    probe = gui.probe_plc('plc')
+    assert probe.online
+    assert probe.error is None
+
+
+def test_probe_plc_checks_online_on_error(fake_plc, monkeypatch):
+    from pmpsdb_client import gui
+
+    def broken_list(hostname):
+        raise TimeoutError('timed out')
+
+    monkeypatch.setattr(gui, 'list_file_info', broken_list)
+    monkeypatch.setattr(gui, 'check_server_online', lambda hostname: False)
+    probe = gui.probe_plc('plc')
+    assert not probe.online
+    assert isinstance(probe.error, TimeoutError)
+
+
+def test_check_server_online_bad_hostname():
+    from pmpsdb_client.gui import check_server_online
+
+    assert not check_server_online('a' * 64 + '.invalid')
+
+
+def test_run_in_background_reports_errors():
+    from pmpsdb_client.gui import PLCProbe, SummaryTables
+
+    emitted = []
+
+    class FakeSignal:
+        def emit(self, row, result):
+            emitted.append((row, result))
+
+    def broken_probe(hostname):
+        raise UnicodeError('bad hostname')
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fake_tables = types.SimpleNamespace(_shutdown=False, _executor=executor)
+        SummaryTables._run_in_background(
+            fake_tables,
+            FakeSignal(),
+            3,
+            lambda exc: PLCProbe(hostname='plc', online=False, error=exc),
+            broken_probe,
+            'plc',
+        )
+    [(row, probe)] = emitted
+    assert row == 3
+    assert isinstance(probe.error, UnicodeError)
+
+
+def test_update_plc_row_runs_in_background():
+    from pmpsdb_client.gui import SummaryTables
+
+    started = []
+    fake_tables = types.SimpleNamespace(
+        _export_pending=set(),
+        plc_table=types.SimpleNamespace(
+            item=lambda row, col: types.SimpleNamespace(text=lambda: 'plc'),
+        ),
+        start_probe=lambda row, hostname: started.append((row, hostname)),
+    )
+    SummaryTables.update_plc_row(fake_tables, 3)
+    assert started == [(3, 'plc')]
+    assert fake_tables._export_pending == {3}